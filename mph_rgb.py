@@ -18,24 +18,58 @@ this program. If not, see <https://www.gnu.org/licenses/>.
 S.D.G.
 """
 
+import functools
+import importlib.util
 import io
+import logging
 import os
 import subprocess
+import sys
+import time
 import tomllib
 from typing import Sequence
+import numpy as np
 from openrgb import OpenRGBClient
+from openrgb.orgb import Device
 from openrgb.utils import RGBColor  # , DeviceType
 from PIL import Image
 
 with open("config.toml", "rb") as f:
     CONFIG = tomllib.load(f)
 
+# Status messages go through logging, so the chattier ones can be turned off from the config.
+# Only our own logger is set up, printing to stdout alongside the device prompt.
+log = logging.getLogger(__name__)
+log.setLevel(CONFIG.get("logLevel", "INFO"))
+log.propagate = False
+_log_handler = logging.StreamHandler(sys.stdout)
+_log_handler.setFormatter(logging.Formatter("%(message)s"))
+log.addHandler(_log_handler)
+
 # The pixel size of each Nintendo DS screen
 DS_SCREEN_SIZE = (256, 192)
 
 # The relative pixel size of the hybrid emulator display area
 EMU_DISP_SIZE = DS_SCREEN_SIZE[0] * 3, DS_SCREEN_SIZE[1] * 2
 
+# Config values we need on every frame, so we don't have to look them up each time
+REF_WIDTH = CONFIG["scale"][0]
+MENUBAR_HEIGHT = CONFIG["emuMenubarHeight"]
+
+# Comparing squared distances saves us a square root
+TOL2 = CONFIG["colorTolerance"] ** 2
+
+# The shortest time to spend on each check of the HUD, since it only changes at human speed
+# A rate of 0 means no cap at all
+POLL_HZ = CONFIG.get("pollHz", 30)
+if POLL_HZ < 0:
+    raise ValueError(f"pollHz must be 0 (no cap) or a positive number of checks per second, not {POLL_HZ}")
+TARGET_DT = 1 / POLL_HZ if POLL_HZ else 0
+
+# The RGB colors to show for each weapon, and for no weapon, made ahead of time
+WEAPON_RGB = {weapon: RGBColor(*color) for weapon, color in CONFIG["weaponColorsShow"].items()}
+OFF_RGB = RGBColor(0, 0, 0)
+
 
 """
 The original plan (was not followed precisely, only kept for historical purposes):
@@ -59,127 +93,387 @@ XORG_COMMAND = "scrot -iuo " + STDOUT_MAGICFILE
 if os.environ.get("XDG_SESSION_TYPE") == "wayland" or os.environ.get("WAYLAND_DISPLAY"):
     # We are using Wayland
     SCSH_COMMAND = WAYLAND_COMMAND
-    print("Detected Wayland.")
+    log.info("Detected Wayland.")
 else:
     # We are probably using XOrg
     SCSH_COMMAND = XORG_COMMAND
-    print("Did not detect Wayland, assuming XOrg.")
+    log.info("Did not detect Wayland, assuming XOrg.")
+
+SCSH_ARGV = SCSH_COMMAND.split()
 
 
-def get_screenshot(wholerender: bool = False) -> Image:
-    """Get a screenshot of the game
+@functools.lru_cache(maxsize=4)
+def _compute_crop(size: tuple[int, int], wholerender: bool = False) -> tuple[int, int, int, int]:
+    """Compute where the HUD screen is within a screenshot of the whole emulator window
 
     Args:
+        size (tuple[int, int]): The width and height of the window screenshot.
         wholerender (bool): Include the entire render rather than cropping to the hud screen.
             Defaults to False.
 
     Returns:
-        shot (Image): The screenshot."""
+        box (tuple[int, int, int, int]): The left, top, right, and bottom of the crop."""
 
-    cp = subprocess.run(SCSH_COMMAND.split(), capture_output=True, check=True)
-    buff = io.BytesIO(cp.stdout)
-    img = Image.open(buff)
-    img = img.crop((0, CONFIG["emuMenubarHeight"], *img.size))
+    # The emulator menubar is not part of the render
+    width, height = size[0], size[1] - MENUBAR_HEIGHT
 
     # Find how much the DS screen is being scaled
-    factor = min((img.width / EMU_DISP_SIZE[0], img.height / EMU_DISP_SIZE[1]))
+    factor = min((width / EMU_DISP_SIZE[0], height / EMU_DISP_SIZE[1]))
 
     # Get the actual size of the render on screen
     correct_size = EMU_DISP_SIZE[0] * factor, EMU_DISP_SIZE[1] * factor
 
     # Find out how much black is around the render
-    margins = max((img.size[0] - correct_size[0], 0)) / 2, max((img.size[1] - correct_size[1], 0)) / 2
+    margins = max((width - correct_size[0], 0)) / 2, max((height - correct_size[1], 0)) / 2
+
+    # Crop off the black margins and the unwanted displays, rounding within the render like Pillow's crop would,
+    # and only then shift down past the menubar, so that halfway cases round the same way
+    return (
+        round(margins[0] + factor * DS_SCREEN_SIZE[0] * 2),
+        MENUBAR_HEIGHT + round(margins[1] + factor * DS_SCREEN_SIZE[1] * (not wholerender)),
+        round(width - margins[0]),
+        MENUBAR_HEIGHT + round(height - margins[1]),
+        )
+
+
+# Program that stays running to take screenshots of a screen region for us, if MSS is unavailable
+SCSH_HELPER_PATH = "scsh_helper.py"
+
+SCT = None
+SCSH_HELPER = None
+
+# If we know where the emulator window is, we can grab the screen directly
+if CONFIG.get("captureRegion"):
+    # Work out the absolute screen region of the HUD once, since the window shouldn't move
+    region_left, region_top, *region_size = CONFIG["captureRegion"]
+    CAPTURE_BOXES = {}
+    for whole in (False, True):
+        crop = _compute_crop(tuple(region_size), whole)
+        CAPTURE_BOXES[whole] = (
+            region_left + crop[0],
+            region_top + crop[1],
+            region_left + crop[2],
+            region_top + crop[3],
+            )
+
+    if importlib.util.find_spec("mss"):
+        import mss
+        SCT = mss.mss()
+        MSS_MONITORS = {
+            whole: {"left": box[0], "top": box[1], "width": box[2] - box[0], "height": box[3] - box[1]}
+            for whole, box in CAPTURE_BOXES.items()
+            }
+        log.info("Capturing the configured screen region with MSS.")
+
+    else:
+        SCSH_HELPER = subprocess.Popen(
+            (sys.executable, SCSH_HELPER_PATH),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            bufsize=-1,
+            )
+        log.info("Capturing the configured screen region with the screenshot helper.")
+
+
+# Reusable buffer for screenshot data read from a pipe, replaced with a bigger one if a screenshot doesn't fit
+_scratch = bytearray(4 * 1024 * 1024)
+
+
+def _read_into_scratch(stream: io.BufferedReader, size: int = None) -> memoryview:
+    """Read screenshot data from a pipe into the reusable scratch buffer
+
+    Args:
+        stream (io.BufferedReader): The pipe to read from.
+        size (int): How many bytes to read.
+            Defaults to None, read until the pipe closes.
+
+    Returns:
+        data (memoryview): The data that was read. Only valid until the next read."""
+
+    global _scratch
+
+    # We know exactly how much is coming
+    if size is not None:
+        if size > len(_scratch):
+            _scratch = bytearray(size)
+        count = stream.readinto(memoryview(_scratch)[:size])
+        if count != size:
+            raise EOFError(f"Pipe closed after {count} of {size} bytes")
+        return memoryview(_scratch)[:size]
+
+    # Read until the pipe closes, moving to a bigger buffer whenever we run out of room
+    length = 0
+    while True:
+        if length == len(_scratch):
+            bigger = bytearray(len(_scratch) * 2)
+            bigger[:length] = _scratch
+            _scratch = bigger
+
+        count = stream.readinto(memoryview(_scratch)[length:])
+        if not count:
+            return memoryview(_scratch)[:length]
+        length += count
+
+
+def _screenshot_mss(wholerender: bool = False) -> np.ndarray:
+    """Get a screenshot of the game straight from the screen with MSS
+
+    Args:
+        wholerender (bool): Include the entire render rather than cropping to the hud screen.
+            Defaults to False.
+
+    Returns:
+        shot (np.ndarray): The screenshot, as an RGB array of shape (height, width, 3)."""
+
+    img = SCT.grab(MSS_MONITORS[wholerender])
 
-    # Crop off the black margins, and the unwanted displays
-    return img.crop((
-        margins[0] + factor * DS_SCREEN_SIZE[0] * 2,
-        margins[1] + factor * DS_SCREEN_SIZE[1] * (not wholerender),
-        img.width - margins[0],
-        img.height - margins[1],
-        ))
+    # MSS gives us BGRA, so drop the alpha and flip to RGB without copying
+    return np.frombuffer(img.raw, np.uint8).reshape(img.height, img.width, 4)[:, :, 2::-1]
 
 
-def distance(vec1: Sequence, vec2: Sequence = None) -> float:
-    """Get the distance between two vectors
+def _screenshot_helper(wholerender: bool = False) -> np.ndarray:
+    """Get a screenshot of the game from the screenshot helper
 
     Args:
-        vec1 (Sequence): The first vector.
-        vec2 (Sequence): The second vector.
-            Defaults to origin in first vector's space.
+        wholerender (bool): Include the entire render rather than cropping to the hud screen.
+            Defaults to False.
 
     Returns:
-        distance (float): The distance between the vectors."""
+        shot (np.ndarray): The screenshot, as an RGB array of shape (height, width, 3).
+            Only valid until the next screenshot."""
 
-    # Default the second vector to the space origin
-    if not vec2:
-        vec2 = [0] * len(vec1)
+    # Ask the screenshot helper for the region
+    try:
+        SCSH_HELPER.stdin.write(b"%d %d %d %d\n" % CAPTURE_BOXES[wholerender])
+        SCSH_HELPER.stdin.flush()
+        header = SCSH_HELPER.stdout.read(8)
+    except BrokenPipeError:
+        header = b""
 
-    # Make sure the vectors are appropriate sizes
-    #assert len(vec1) == len(vec2), \
-    #    f"Cannot compute distance between vectors in different number of dimensions, {len(vec1)} and {len(vec2)}"
+    # The reply is cut short only if the helper has died
+    if len(header) != 8:
+        raise RuntimeError(f"Screenshot helper stopped responding, exit status {SCSH_HELPER.poll()}")
 
-    return sum((p2 - p1) ** 2 for p1, p2 in zip(vec1, vec2)) ** 0.5
+    # Read back the raw pixels
+    width = int.from_bytes(header[:4], "little")
+    height = int.from_bytes(header[4:], "little")
+    pixels = _read_into_scratch(SCSH_HELPER.stdout, width * height * 3)
+    return np.frombuffer(pixels, np.uint8).reshape(height, width, 3)
 
 
-def color_sense(screenshot: Image, coords: Sequence, color: Sequence) -> bool:
-    """Determine if a color is at the given location on the HUD, taking scale into account
+def _screenshot_command(wholerender: bool = False) -> np.ndarray:
+    """Get a screenshot of the game with the screenshot command
 
     Args:
-        screenshot (Image): The HUD screenshot.
-        coords (Sequence): The coordinates to look at.
-        color: (Sequence): The color to look for.
+        wholerender (bool): Include the entire render rather than cropping to the hud screen.
+            Defaults to False.
 
     Returns:
-        result (bool): Is the color matching within tolerance?"""
+        shot (np.ndarray): The screenshot, as an RGB array of shape (height, width, 3)."""
+
+    with subprocess.Popen(SCSH_ARGV, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL) as proc:
+        data = _read_into_scratch(proc.stdout)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, SCSH_ARGV)
+
+    buff = io.BytesIO(data)
+    img = Image.open(buff)
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGB")
+
+    # Convert the whole screenshot once, then crop it and drop any alpha by slicing, which doesn't copy
+    left, top, right, bottom = _compute_crop(img.size, wholerender)
+    return np.asarray(img)[top:bottom, left:right, :3]
+
+
+# Decide how to get screenshots once, rather than on every frame
+if SCT:
+    get_screenshot = _screenshot_mss
+elif SCSH_HELPER:
+    get_screenshot = _screenshot_helper
+else:
+    get_screenshot = _screenshot_command
+
+
+# Every color probe on the HUD, stacked so that they can all be checked at once
+PROBE_COORDS = []  # Reference coordinates of each probe
+PROBE_COLORS = []  # Color each probe looks for
+HUNTER_PROBES = {}  # Hunter name: Index of its HUD probe
+WEAPON_PROBES = {}  # Hunter name: ({main weapon: index}, {third weapon: index})
+
+for hunter, specs in CONFIG["hunterSpecs"].items():
+    HUNTER_PROBES[hunter] = len(PROBE_COORDS)
+    PROBE_COORDS.append(specs["isHudCoords"])
+    PROBE_COLORS.append(specs["isHudColor"])
+
+for hunter, specs in CONFIG["hunterSpecs"].items():
+    main_probes = {}
+    for weapon, coords in specs["mainWeaponCoords"].items():
+        main_probes[weapon] = len(PROBE_COORDS)
+        PROBE_COORDS.append(coords)
+        PROBE_COLORS.append(specs["mainWeaponSenseColor"])
+
+    third_probes = {}
+    for weapon, coords in specs["thirdWeaponCoords"].items():
+        third_probes[weapon] = len(PROBE_COORDS)
+        PROBE_COORDS.append(coords)
+        PROBE_COLORS.append(specs["thirdWeaponSenseColors"][weapon])
+
+    WEAPON_PROBES[hunter] = main_probes, third_probes
+
+PROBE_COORDS = np.array(PROBE_COORDS, dtype=np.intp)
+PROBE_COLORS = np.array(PROBE_COLORS, dtype=np.int32)
+
+# The probe coordinates scaled to the last screenshot size we saw
+_scale_cache = {"size": None, "xs": None, "ys": None}
+
+# The probed pixels and results from the last screenshot
+_last_probe = {"pixels": None, "hits": None}
+
 
-    # Scale the coordinates and clip them to the screenshot size
-    factor = screenshot.width / CONFIG["scale"][0]
-    scaled_coords = tuple(max((min((int(coords[i] * factor + 0.5), screenshot.size[i] - 1)), 0)) for i in range(2))
+def _rescale_probes(size: tuple[int, int]):
+    """Scale every probe to a new screenshot size, clipped to fit
+
+    Args:
+        size (tuple[int, int]): The width and height of the screenshot."""
+
+    scaled = (PROBE_COORDS * (size[0] / REF_WIDTH) + 0.5).astype(np.intp)
+    np.clip(scaled, 0, np.array(size) - 1, out=scaled)
+    _scale_cache.update(size=size, xs=scaled[:, 0], ys=scaled[:, 1])
+
+
+# If we have Numba, compile the comparison, which avoids NumPy's temporary arrays
+if importlib.util.find_spec("numba"):
+    import numba
+
+    @numba.njit(cache=True)
+    def _match_probes_kernel(pixels: np.ndarray, colors: np.ndarray, tol2: int, hits: np.ndarray):
+        """Compare the pixel under each probe to the color that probe looks for, in compiled code
+
+        Args:
+            pixels (np.ndarray): The pixel at each probe, as an array of shape (probes, 3).
+            colors (np.ndarray): The color each probe looks for, as an array of shape (probes, 3).
+            tol2 (int): The squared color tolerance.
+            hits (np.ndarray): Where to write whether each pixel matched."""
+
+        for k in range(pixels.shape[0]):
+            d_red = int(pixels[k, 0]) - colors[k, 0]
+            d_green = int(pixels[k, 1]) - colors[k, 1]
+            d_blue = int(pixels[k, 2]) - colors[k, 2]
+            hits[k] = d_red * d_red + d_green * d_green + d_blue * d_blue < tol2
+
+    _hits_buffer = np.empty(len(PROBE_COORDS), dtype=np.bool_)
+
+else:
+    _match_probes_kernel = None
+
+
+def _match_probes(pixels: np.ndarray) -> np.ndarray:
+    """Compare the pixel under each probe to the color that probe looks for
+
+    Args:
+        pixels (np.ndarray): The pixel at each probe, as an array of shape (probes, 3).
+
+    Returns:
+        hits (np.ndarray): Whether each pixel matched its probe color within tolerance."""
+
+    if _match_probes_kernel:
+        _match_probes_kernel(pixels, PROBE_COLORS, TOL2, _hits_buffer)
+        return _hits_buffer
+
+    return ((pixels.astype(np.int32) - PROBE_COLORS) ** 2).sum(axis=1) < TOL2
+
+
+# Compile now, rather than stalling on the first frame
+if _match_probes_kernel:
+    _match_probes(np.zeros((len(PROBE_COORDS), 3), dtype=np.uint8))
+
+
+def sense_hud(screenshot: np.ndarray) -> np.ndarray:
+    """Check every color probe on the HUD at once, taking scale into account
+
+    Args:
+        screenshot (np.ndarray): The HUD screenshot.
+
+    Returns:
+        hits (np.ndarray): Whether each probe in PROBE_COORDS matched its color within tolerance."""
+
+    # Rescale the probes only when the screenshot size changes
+    size = screenshot.shape[1], screenshot.shape[0]
+    if size != _scale_cache["size"]:
+        _rescale_probes(size)
+
+    # If none of the probed pixels changed since last time, neither did the results
+    pixels = screenshot[_scale_cache["ys"], _scale_cache["xs"]]
+    pixel_bytes = pixels.tobytes()
+    if pixel_bytes == _last_probe["pixels"]:
+        return _last_probe["hits"]
 
     # Actually do the detection
-    return distance(screenshot.getpixel(scaled_coords), color) < CONFIG["colorTolerance"]
+    hits = _match_probes(pixels)
+    _last_probe.update(pixels=pixel_bytes, hits=hits)
+    return hits
 
 
-def get_active_hunter(screenshot: Image) -> str | None:
+def get_active_hunter(hits: np.ndarray, prev_hunter: str = None) -> str | None:
     """Detect the currently active hunter
 
     Args:
-        screenshot (Image): The current lower display screenshot.
+        hits (np.ndarray): The HUD probe results for the current screenshot.
+        prev_hunter (str): The previously detected hunter, which is checked first.
+            Defaults to None.
 
     Returns:
         result (str | None): The detected hunter's name, or None if not in first-person."""
 
+    # The hunter almost never changes between screenshots, so check the last one first
+    if prev_hunter and hits[HUNTER_PROBES[prev_hunter]]:
+        return prev_hunter
+
     # check for each hunter's HUD
-    for hunter, specs in CONFIG["hunterSpecs"].items():
-        if color_sense(screenshot, specs["isHudCoords"], specs["isHudColor"]):
+    for hunter, index in HUNTER_PROBES.items():
+        if hits[index]:
             return hunter
 
     # No hunter HUD was found
     return None
 
 
-def get_active_weapon(screenshot: Image, hunter: str = None) -> str:
+def get_active_weapon(hits: np.ndarray, hunter: str = None, prev_weapon: str = None) -> str:
     """Get the current active weapon
 
     Args:
-        screenshot (Image): The current screenshot of the lower screen.
+        hits (np.ndarray): The HUD probe results for the current screenshot.
         hunter (str): The name of the currently active hunter.
             Defaults to None, auto-detect.
+        prev_weapon (str): The previously detected weapon, which is checked first.
+            Defaults to None.
 
     Returns:
         weapon (str | None): The currently active weapon by TOML name, or None."""
 
     # Try to detect the hunter if we were not passed one
-    hunter = hunter or get_active_hunter(screenshot)
+    hunter = hunter or get_active_hunter(hits)
 
     # No hunter was passed and we didn't detect one
     if not hunter:
         return None
 
+    main_probes, third_probes = WEAPON_PROBES[hunter]
+
+    # The weapon rarely changes between screenshots, so check the last one first
+    if prev_weapon in main_probes:
+        if hits[main_probes[prev_weapon]]:
+            return prev_weapon
+
+    elif prev_weapon in third_probes:
+        if hits[main_probes["third"]] and hits[third_probes[prev_weapon]]:
+            return prev_weapon
+
     # Detect main weapon category
     main_weapon = None
-    for weapon, coords in CONFIG["hunterSpecs"][hunter]["mainWeaponCoords"].items():
-        if color_sense(screenshot, coords, CONFIG["hunterSpecs"][hunter]["mainWeaponSenseColor"]):
+    for weapon, index in main_probes.items():
+        if hits[index]:
             main_weapon = weapon
 
     # No weapon was active. We are probably in map.
@@ -191,8 +485,8 @@ def get_active_weapon(screenshot: Image, hunter: str = None) -> str:
         return main_weapon
 
     # A third special weapon is active
-    for weapon, coords in CONFIG["hunterSpecs"][hunter]["thirdWeaponCoords"].items():
-        if color_sense(screenshot, coords, CONFIG["hunterSpecs"][hunter]["thirdWeaponSenseColors"][weapon]):
+    for weapon, index in third_probes.items():
+        if hits[index]:
             return weapon
 
     # Somehow, weapon detection failed
@@ -256,6 +550,25 @@ def multiple_choice(title: str, options: Sequence[str]) -> str:
             print("Invalid entry. Please type a number or the option itself.")
 
 
+# The last color we sent to the RGB device
+_last_color = None
+
+
+def set_color(device: Device, color: RGBColor):
+    """Set the color of the RGB device, unless it is already that color
+
+    Args:
+        device (Device): The OpenRGB device to set.
+        color (RGBColor): The color to set."""
+
+    global _last_color
+
+    # Every color change is a round trip to the OpenRGB server, so skip ones that do nothing
+    if color != _last_color:
+        device.set_color(color)
+        _last_color = color
+
+
 client = OpenRGBClient()
 
 try:
@@ -269,44 +582,59 @@ try:
     prev_weapon = None
 
     # Initial color should assume no hunter is active
-    device.set_color(RGBColor(0, 0, 0))
+    set_color(device, OFF_RGB)
 
     # Program continues until interrupted
     print("Press Ctrl+C to stop the program when done playing.")
     while True:
+        frame_start = time.perf_counter()
+
         # Constantly scan the emulator screen
         screenshot = get_screenshot()
+        hits = sense_hud(screenshot)
 
         # If not hunter is active, this will be None
-        hunter = get_active_hunter(screenshot)
+        hunter = get_active_hunter(hits, prev_hunter)
 
         # Hunter memory is mainly for debug. It's a weapon change we care about
         if hunter != prev_hunter:
-            print("Hew hunter detected:", hunter)
+            log.debug("Hew hunter detected: %s", hunter)
             prev_hunter = hunter
 
         # Detect the current weapon in use, but only if a hunter is active.
         # If no hunter is active, the weapon will of course be None as well
-        weapon = get_active_weapon(screenshot, hunter) if hunter else None
+        weapon = get_active_weapon(hits, hunter, prev_weapon) if hunter else None
 
         # There has been a weapon change
         if weapon != prev_weapon:
             # Note the change to memory
-            print("New weapon detected:", weapon)
+            log.info("New weapon detected: %s", weapon)
             prev_weapon = weapon
 
             # Note: Weapon can only and will always be None if hunter is None
             # When there is no hunter/weapon, turn the lights off
             if not weapon:
-                device.set_color(RGBColor(0, 0, 0))
+                set_color(device, OFF_RGB)
 
             # Otherwise, set the appropiate color for the new weapon selection
             else:
-                device.set_color(RGBColor(*CONFIG["weaponColorsShow"][weapon]))
+                set_color(device, WEAPON_RGB[weapon])
+
+        # Don't check again sooner than we need to
+        spare_time = TARGET_DT - (time.perf_counter() - frame_start)
+        if spare_time > 0:
+            time.sleep(spare_time)
 
 # When we abort with Ctrl+C
 finally:
     # We have to do this or the OpenRGB server keeps a ghost connection open indefinitely
-    print("Disconnecting OpenRGB client")
+    log.info("Disconnecting OpenRGB client")
     client.disconnect()
-    print("Done.")
+
+    # The screenshot helper exits once its input is closed
+    if SCSH_HELPER:
+        log.info("Stopping screenshot helper")
+        SCSH_HELPER.stdin.close()
+        SCSH_HELPER.wait()
+
+    log.info("Done.")
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""Metroid Prime: Hunters RGB screenshot helper
+
+Stays running and screenshots a screen region whenever asked, so that we don't
+have to start a new screenshot program for every frame.
+
+Each request is a line on stdin with the left, top, right, and bottom of the
+region. Each reply on stdout is the width and height of the screenshot as
+4-byte little-endian integers, followed by its raw RGB pixels. Close stdin to
+stop.
+
+This program is free software: you can redistribute it and/or modify it under
+the terms of the GNU General Public License as published by the Free Software
+Foundation, either version 3 of the License, or (at your option) any later
+version.
+
+This program is distributed in the hope that it will be useful, but WITHOUT ANY
+WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR A
+PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License along with
+this program. If not, see <https://www.gnu.org/licenses/>.
+
+S.D.G.
+"""
+
+import signal
+import sys
+from PIL import ImageGrab
+
+# Ctrl+C in the terminal reaches us too, but the main program still needs us while it shuts down.
+# We stop when it closes our input instead.
+signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+# Reading line by line means we end on our own when the main program closes the pipe
+for line in sys.stdin:
+    bbox = tuple(int(edge) for edge in line.split())
+
+    # Raw pixels are much cheaper to send than to encode and decode a PNG
+    img = ImageGrab.grab(bbox).convert("RGB")
+    sys.stdout.buffer.write(img.width.to_bytes(4, "little") + img.height.to_bytes(4, "little"))
+    sys.stdout.buffer.write(img.tobytes())
+    sys.stdout.buffer.flush()